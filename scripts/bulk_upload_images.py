@@ -1,15 +1,72 @@
 import os
 import sys
 import json
+import functools
 import argparse
 import requests
 import re
+import time
+import queue
+import threading
+import contextlib
+from requests.adapters import HTTPAdapter
+from requests_toolbelt.multipart.encoder import MultipartEncoder
+from urllib3.util.retry import Retry
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from pathlib import Path
 
+try:
+    import orjson # Optional: much faster (de)serialization of GraphQL payloads
+except ImportError:
+    orjson = None
+
 # --- CONFIG ---
 SHOPIFY_API_VERSION = "2024-10" # Update as needed
+GRAPHQL_MAX_ATTEMPTS = 3
+UPLOAD_MAX_ATTEMPTS = 3
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+THROTTLE_MIN_AVAILABLE = 100 # Query cost points to keep in the bucket before pausing
+IMAGE_MIME_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp"
+}
+
+HEADERS_TEMPLATE = {"Content-Type": "application/json"}
+
+# Endpoint, headers and session shared by every Shopify call in a run (GraphQL and staged uploads)
+GraphQLContext = namedtuple("GraphQLContext", ["url", "headers", "session"])
+
+# Shared session so all workers reuse pooled TCP/TLS connections.
+# urllib3 only retries idempotent methods on status codes, so the adapter never replays POSTs;
+# graphql_query and put_staged_file decide which POSTs are safe to retry.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+))
+
+def _json_dumps(obj, indent=False, default=None):
+    """Serialize to UTF-8 JSON bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=default, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=2 if indent else None, default=default).encode("utf-8")
 
+def _json_loads(data):
+    """Parse JSON bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# Runs of anything that isn't Unicode alphanumeric. \W alone would keep '_',
+# so [\W_] matches exactly the characters for which str.isalnum() is False.
+_NON_ALNUM_RE = re.compile(r"[\W_]+")
+
+@functools.lru_cache(maxsize=16384)
 def normalize_token(text):
     """
     Strict Tokenization:
@@ -17,26 +74,19 @@ def normalize_token(text):
     - Keep only Unicode alphanumeric characters
     - Replace everything else with space
     - Split by whitespace
+    Returns a tuple so cached results can be shared safely between callers.
     """
     if not text:
-        return []
-    
-    # 1. Lowercase
-    text = text.lower()
-    
-    # 2. Iterate chars, keep alnum, else space
-    # Python's isalnum() is Unicode-aware (checks Unicode properties)
-    clean_chars = []
-    for char in text:
-        if char.isalnum():
-            clean_chars.append(char)
-        else:
-            clean_chars.append(" ")
+        return ()
     
-    cleaned_text = "".join(clean_chars)
-    
-    # 3. Split
-    return cleaned_text.split()
+    # Lowercase, then replace non-alnum runs in one C-level pass
+    return tuple(_NON_ALNUM_RE.sub(" ", text.lower()).split())
+
+_NUM_SPLIT = re.compile(r"(\d+)")
+
+def _natkey(name):
+    """Natural sort key on a file name (img_2 before img_10)."""
+    return [int(t) if t.isdigit() else t.lower() for t in _NUM_SPLIT.split(name)]
 
 def get_offline_token(base_url, secret, shop=None):
     """Fetch offline access token from internal endpoint."""
@@ -48,7 +98,7 @@ def get_offline_token(base_url, secret, shop=None):
     
     print(f"🔑 Fetching token from {url}...")
     try:
-        resp = requests.get(url, headers=headers, params=params, timeout=10)
+        resp = SESSION.get(url, headers=headers, params=params, timeout=10)
         if resp.status_code == 200:
             data = resp.json()
             print(f"✅ Token acquired for shop: {data['shop']}")
@@ -66,24 +116,62 @@ def get_offline_token(base_url, secret, shop=None):
         print(f"❌ Connection error: {e}")
         sys.exit(1)
 
-def graphql_query(shop, access_token, query, variables=None):
-    """Execute Shopify Admin GraphQL Query."""
-    url = f"https://{shop}/admin/api/{SHOPIFY_API_VERSION}/graphql.json"
-    headers = {
-        "X-Shopify-Access-Token": access_token,
-        "Content-Type": "application/json"
-    }
-    resp = requests.post(url, json={"query": query, "variables": variables}, headers=headers)
-    resp.raise_for_status()
-    result = resp.json()
-    if "errors" in result:
-        raise Exception(f"GraphQL Error: {json.dumps(result['errors'])}")
-    if "data" not in result:
-        raise Exception("No data in GraphQL response")
-    return result["data"]
-
-def fetch_products_by_tag(shop, access_token, tag):
-    """Fetch all products with the given tag."""
+class RetryableGraphQLError(Exception):
+    """Transient GraphQL failure that is safe to retry (throttled, or 5xx on an idempotent call)."""
+
+def _throttle_pause(result):
+    """Seconds to wait so the cost bucket refills to THROTTLE_MIN_AVAILABLE, or 0."""
+    status = result.get("extensions", {}).get("cost", {}).get("throttleStatus")
+    if not status:
+        return 0
+    missing = THROTTLE_MIN_AVAILABLE - status["currentlyAvailable"]
+    if missing <= 0 or not status.get("restoreRate"):
+        return 0
+    return missing / status["restoreRate"]
+
+def make_graphql_context(shop, access_token):
+    """Build the endpoint URL and headers once per run instead of on every call."""
+    return GraphQLContext(
+        url=f"https://{shop}/admin/api/{SHOPIFY_API_VERSION}/graphql.json",
+        headers={**HEADERS_TEMPLATE, "X-Shopify-Access-Token": access_token},
+        session=SESSION
+    )
+
+def graphql_query(gql, query, variables=None, idempotent=False):
+    """
+    Execute Shopify Admin GraphQL Query, retrying with exponential backoff.
+    HTTP 429 and THROTTLED errors never executed, so they are always retried. A 5xx may
+    arrive after a mutation was already applied, so it is only retried when `idempotent`.
+    """
+    for attempt in range(GRAPHQL_MAX_ATTEMPTS):
+        try:
+            resp = gql.session.post(gql.url, data=_json_dumps({"query": query, "variables": variables}), headers=gql.headers)
+            if resp.status_code == 429 or (idempotent and resp.status_code in RETRYABLE_STATUS):
+                raise RetryableGraphQLError(f"HTTP {resp.status_code}")
+            resp.raise_for_status()
+            result = _json_loads(resp.content)
+            if "errors" in result:
+                errors = result["errors"]
+                # Shopify sometimes returns a plain string here instead of a list
+                if isinstance(errors, list) and errors and errors[0].get("extensions", {}).get("code") == "THROTTLED":
+                    raise RetryableGraphQLError(f"GraphQL Error: {json.dumps(result['errors'])}")
+                raise Exception(f"GraphQL Error: {json.dumps(result['errors'])}")
+            if "data" not in result:
+                raise Exception("No data in GraphQL response")
+        except RetryableGraphQLError:
+            if attempt == GRAPHQL_MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(2 ** attempt)
+            continue
+        
+        # Back off proactively when the cost bucket is nearly drained
+        pause = _throttle_pause(result)
+        if pause:
+            time.sleep(pause)
+        return result["data"]
+
+def iter_products_by_tag(gql, tag):
+    """Yield products with the given tag one at a time, page by page."""
     print(f"📦 Fetching products with tag: '{tag}'...")
     query = """
     query getProducts($query: String!, $cursor: String) {
@@ -103,178 +191,275 @@ def fetch_products_by_tag(shop, access_token, tag):
     }
     """
     
-    all_products = []
+    count = 0
     cursor = None
     has_next = True
     
     with tqdm(desc="Fetching Products", unit="page") as pbar:
         while has_next:
-            data = graphql_query(shop, access_token, query, {"query": f"tag:{tag}", "cursor": cursor})
+            data = graphql_query(gql, query, {"query": f"tag:{tag}", "cursor": cursor}, idempotent=True)
             products_data = data["products"]
             
             for edge in products_data["edges"]:
-                all_products.append(edge["node"])
+                count += 1
+                yield edge["node"]
             
             has_next = products_data["pageInfo"]["hasNextPage"]
             cursor = products_data["pageInfo"]["endCursor"]
             pbar.update(1)
             
-    print(f"✅ Found {len(all_products)} products.")
-    return all_products
+    print(f"✅ Found {count} products.")
+
+def _scan_one_product_folder(entry):
+    """Return the folder dict for a product folder with an 'Etulle Shopify' image subfolder, else None."""
+    folder_name = entry.name
+    # Check for "Etulle Shopify" subfolder (case-insensitive)
+    sub_entry = None
+    with os.scandir(entry.path) as sit:
+        for sub in sit:
+            if sub.name.lower() == "etulle shopify":
+                 sub_entry = sub
+                 break
+    
+    if not (sub_entry and sub_entry.is_dir()):
+        return None
+    
+    sub_path = sub_entry.path
+    # Found valid product folder
+    # List images
+    images = []
+    with os.scandir(sub_path) as iit:
+        for f in iit:
+            mime_type = IMAGE_MIME_TYPES.get(os.path.splitext(f.name)[1].lower())
+            if mime_type:
+                # Size and MIME are captured once here and reused by every upload step
+                images.append({
+                    "path": f.path,
+                    "name": f.name,
+                    "size": f.stat().st_size,
+                    "mime": mime_type
+                })
+    
+    # Numeric Sort: _1, _2, _10...
+    # We assume filenames have numbers. If not, simple sort.
+    # Using regex to find last number for robust numeric sort if defined, strictly use name
+    # User requirement: "numeric sort (_1, _2, _10)"
+    # Let's use a natural sort key
+    images.sort(key=lambda img: _natkey(img["name"]))
+    
+    if len(images) == 0:
+        return None
+    
+    tokens = frozenset(normalize_token(folder_name)) # Frozen: hash is cached, fast subset check
+    return {
+        "name": folder_name,
+        "path": sub_path,
+        "images": images,
+        "tokens": tokens,
+        "ntokens": len(tokens)
+    }
 
-def scan_folders(root_folder):
-    """Scan root folder for product folders containing 'Etulle Shopify'."""
+def scan_folders(root_folder, workers=16):
+    """
+    Scan root folder for product folders containing 'Etulle Shopify'.
+    Returns the folders and a token -> [folder index] map (in folder order) used to
+    shortlist match candidates.
+    """
     print(f"📂 Scanning folders in: {root_folder}")
     valid_folders = []
+    folders_by_token = defaultdict(list)
     
     if not os.path.exists(root_folder):
         print("❌ Root folder does not exist!")
         sys.exit(1)
 
-    # List only directories
-    candidates = [d for d in os.listdir(root_folder) if os.path.isdir(os.path.join(root_folder, d))]
-    
-    for folder_name in candidates:
-        full_path = os.path.join(root_folder, folder_name)
-        # Check for "Etulle Shopify" subfolder (case-insensitive)
-        sub_path = None
-        for sub in os.listdir(full_path):
-            if sub.lower() == "etulle shopify":
-                 sub_path = os.path.join(full_path, sub)
-                 break
-        
-        if sub_path and os.path.isdir(sub_path):
-            # Found valid product folder
-            # List images
-            images = []
-            for f in os.listdir(sub_path):
-                if f.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')):
-                    images.append(os.path.join(sub_path, f))
-            
-            # Numeric Sort: _1, _2, _10...
-            # We assume filenames have numbers. If not, simple sort.
-            # Using regex to find last number for robust numeric sort if defined, strictly use name
-            # User requirement: "numeric sort (_1, _2, _10)"
-            # Let's use a natural sort key
-            images.sort(key=lambda s: [int(t) if t.isdigit() else t.lower() for t in re.split('(\d+)', s)])
-            
-            if len(images) > 0:
-                valid_folders.append({
-                    "name": folder_name,
-                    "path": sub_path,
-                    "images": images,
-                    "tokens": set(normalize_token(folder_name)) # Set for faster subset check
-                })
+    # List only directories (DirEntry caches the file type, avoiding a stat per entry)
+    with os.scandir(root_folder) as it:
+        candidates = [e for e in it if e.is_dir()]
+    
+    # Per-folder listing is latency-bound (slow disks, SMB shares), so walk folders in parallel.
+    # map() keeps the listing order, which keeps matching and collision reports stable.
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for folder in ex.map(_scan_one_product_folder, candidates):
+            if folder is None:
+                continue
+            for t in folder["tokens"]:
+                folders_by_token[t].append(len(valid_folders))
+            valid_folders.append(folder)
     
     print(f"✅ Found {len(valid_folders)} folders with content.")
-    return valid_folders
+    return valid_folders, dict(folders_by_token)
 
-def match_products_to_folders(products, folders):
+class ProductMatcher:
     """
-    Match products to folders using Token Subset logic.
-    Resolves collisions by prioritizing unique matches iteratively.
+    Incremental Token Subset matcher; resolves collisions by prioritizing unique matches iteratively.
+    Products are fed one at a time with add(); the first resolution pass runs as they arrive,
+    so unique matches can start uploading while products are still being fetched.
+    resolve() runs the remaining passes once every product has been added.
     """
-    print("🧩 Matching products to folders...")
-    
-    # 1. Calculate All Candidates for every product
-    product_candidates = []
-    
-    # Pre-calculate folder tokens map for speed (already done in simple scan, ensuring logic holds)
-    
-    print("   Building candidate maps...")
-    for p in tqdm(products, desc="Analyzing Candidates"):
-        p_tokens = set(normalize_token(p["title"]))
-        if not p_tokens:
-            product_candidates.append({"product": p, "candidates": [], "match_type": "no_tokens"})
-            continue
-            
-        candidates = []
-        for f in folders:
-            if p_tokens.issubset(f["tokens"]):
-                candidates.append(f)
+
+    def __init__(self, folders, folders_by_token):
+        self.folders = folders
+        # Token -> folder indexes from scan_folders, so each product only checks a few folders
+        self.folders_by_token = folders_by_token
+        self.product_candidates = []
+        self.assigned_folders = set() # Set of folder paths (unique identifiers)
+        self.matched_results = []
+        self.first_pass_progress = False
+
+    def _iter_candidates(self, p_tokens):
+        """Yield folders whose tokens are a superset of the product's tokens, in folder order."""
+        # Every candidate must contain the product's rarest token, so its bucket is the shortlist.
+        # A token no folder has means there are no candidates at all.
+        rarest = min(p_tokens, key=lambda t: len(self.folders_by_token.get(t, ())))
         
-        product_candidates.append({"product": p, "candidates": candidates, "match_type": None})
+        for i in self.folders_by_token.get(rarest, ()): # Buckets are in folder scan order
+            f = self.folders[i]
+            # A folder with fewer tokens than the product can never be a superset
+            if len(p_tokens) <= f["ntokens"] and p_tokens.issubset(f["tokens"]):
+                yield f
 
-    # 2. Iterative Resolution
-    # We loop until no new unique assignments are made.
-    assigned_folders = set() # Set of folder paths (unique identifiers)
-    matched_results = []
-    
-    pass_count = 0
-    while True:
-        pass_count += 1
-        progress_made = False
+    def _available(self, item, need=None):
+        """
+        Candidates not yet assigned to another product, in folder order.
+        Candidates are discovered lazily: scanning stops once `need` are available
+        (None = find them all), and resumes later if some of them get assigned.
+        """
+        # Filter candidates that are not yet assigned to another product
+        available = [f for f in item["candidates"] if f["path"] not in self.assigned_folders]
+        
+        pending = item["pending"]
+        while pending is not None and (need is None or len(available) < need):
+            f = next(pending, None)
+            if f is None:
+                item["pending"] = pending = None
+                break
+            item["candidates"].append(f)
+            if f["path"] not in self.assigned_folders:
+                available.append(f)
+        return available
+
+    def _try_assign(self, item):
+        """Assign the product if exactly 1 available (unassigned) candidate remains."""
+        # Two available candidates already make this a collision for now; no need to find more
+        available = self._available(item, need=2)
+        
+        if len(available) != 1:
+            return None
         
-        # Find products with exactly 1 available (unassigned) candidate
-        for item in product_candidates:
-            if item["match_type"]: continue # Already resolved
+        # MATCH FOUND
+        chosen_folder = available[0]
+        item["match_type"] = "matched"
+        item["final_folder"] = chosen_folder
+        item["pending"] = None
+        
+        self.assigned_folders.add(chosen_folder["path"])
+        match = {
+            "product": item["product"],
+            "folder": chosen_folder
+        }
+        self.matched_results.append(match)
+        return match
+
+    def add(self, product):
+        """Add one product and run its first-pass resolution. Returns the match or None."""
+        p_tokens = set(normalize_token(product["title"]))
+        if not p_tokens:
+            self.product_candidates.append({"product": product, "candidates": [], "pending": None, "match_type": "no_tokens"})
+            return None
+        
+        item = {"product": product, "candidates": [], "pending": self._iter_candidates(p_tokens), "match_type": None}
+        self.product_candidates.append(item)
+        
+        # Pass 1 walks products in order, so running it on arrival gives the same result
+        match = self._try_assign(item)
+        if match:
+            self.first_pass_progress = True
+        return match
+
+    def resolve(self):
+        """
+        Run the remaining resolution passes until no new unique assignments are made.
+        Returns the matches found after the first pass.
+        """
+        new_matches = []
+        pass_count = 1
+        progress_made = self.first_pass_progress
+        while progress_made:
+            pass_count += 1
+            progress_made = False
             
-            # Filter candidates that are not yet assigned to another product
-            available = [f for f in item["candidates"] if f["path"] not in assigned_folders]
+            for item in self.product_candidates:
+                if item["match_type"]: continue # Already resolved
+                match = self._try_assign(item)
+                if match:
+                    new_matches.append(match)
+                    progress_made = True
+                
+        print(f"   Resolved matches in {pass_count} passes.")
+        return new_matches
+
+    def classify(self):
+        """Split the products left after resolve() into unmatched and collision reports."""
+        unmatched_results = []
+        collision_results = []
+        
+        for item in self.product_candidates:
+            if item.get("match_type") == "matched":
+                continue
+                
+            if item.get("match_type") == "no_tokens":
+                 unmatched_results.append({"product": item["product"]["title"], "reason": "No tokens"})
+                 continue
+
+            # Check remaining available for reporting (finds the full list for collisions)
+            available = self._available(item)
             
-            if len(available) == 1:
-                # MATCH FOUND
-                chosen_folder = available[0]
-                item["match_type"] = "matched"
-                item["final_folder"] = chosen_folder
+            if len(available) == 0:
+                # It might be that it had candidates, but they were all taken by better matches
+                reason = "No matching folders found"
+                if len(item["candidates"]) > 0:
+                    reason = "All matching folders were assigned to other products"
+                unmatched_results.append({"product": item["product"]["title"], "reason": reason})
                 
-                assigned_folders.add(chosen_folder["path"])
-                matched_results.append({
-                    "product": item["product"],
-                    "folder": chosen_folder
+            elif len(available) > 1:
+                # Genuine collision remaining
+                collision_results.append({
+                    "product": item["product"]["title"],
+                    "folders": [f["name"] for f in available]
                 })
-                progress_made = True
                 
-        if not progress_made:
-            break
-            
-    print(f"   Resolved matches in {pass_count} passes.")
+        return unmatched_results, collision_results
 
-    # 3. Final Classification
-    unmatched_results = []
-    collision_results = []
+def register_staged_file(gql, resource_url, filename):
+    """Register a staged upload in the Shopify Files API via fileCreate."""
+    file_create_query = """
+    mutation fileCreate($files: [FileCreateInput!]!) {
+      fileCreate(files: $files) {
+        files {
+          id
+          fileStatus
+        }
+        userErrors { field message }
+      }
+    }
+    """
+    file_create_vars = {
+        "files": [{
+            "originalSource": resource_url,
+            "filename": filename
+        }]
+    }
     
-    for item in product_candidates:
-        if item.get("match_type") == "matched":
-            continue
-            
-        if item.get("match_type") == "no_tokens":
-             unmatched_results.append({"product": item["product"]["title"], "reason": "No tokens"})
-             continue
-
-        # Check remaining available for reporting
-        available = [f for f in item["candidates"] if f["path"] not in assigned_folders]
-        
-        if len(available) == 0:
-            # It might be that it had candidates, but they were all taken by better matches
-            reason = "No matching folders found"
-            if len(item["candidates"]) > 0:
-                reason = "All matching folders were assigned to other products"
-            unmatched_results.append({"product": item["product"]["title"], "reason": reason})
-            
-        elif len(available) > 1:
-            # Genuine collision remaining
-            collision_results.append({
-                "product": item["product"]["title"],
-                "folders": [f["name"] for f in available]
-            })
-            
-    return matched_results, unmatched_results, collision_results
+    fc_res = graphql_query(gql, file_create_query, file_create_vars)
+    if fc_res["fileCreate"]["userErrors"]:
+        raise Exception(f"File Create Error: {fc_res['fileCreate']['userErrors']}")
 
-def upload_image(shop, access_token, product_id, file_path):
+def stage_uploads(gql, images):
     """
-    Upload a single image to Shopify:
-    1. structuredUploadsCreate (get url)
-    2. PUT (upload bytes)
-    3. productCreateMedia (link to product)
+    Request staged upload targets for several images with one stagedUploadsCreate call.
+    `images` are the image dicts from scan_folders; targets come back in the same order.
     """
-    filename = os.path.basename(file_path)
-    filesize = str(os.path.getsize(file_path))
-    mime_type = "image/jpeg"
-    if filename.lower().endswith(".png"): mime_type = "image/png"
-    elif filename.lower().endswith(".webp"): mime_type = "image/webp"
-
-    # 1. Staged Upload Create
     staged_query = """
     mutation stagedUploadsCreate($input: [StagedUploadInput!]!) {
       stagedUploadsCreate(input: $input) {
@@ -290,80 +475,81 @@ def upload_image(shop, access_token, product_id, file_path):
       }
     }
     """
-    staged_vars = {
-        "input": [{
-            "filename": filename,
-            "mimeType": mime_type,
+    staged_input = []
+    for img in images:
+        staged_input.append({
+            "filename": img["name"],
+            "mimeType": img["mime"],
             "resource": "IMAGE",
-            "fileSize": filesize,
+            "fileSize": str(img["size"]),
             "httpMethod": "POST" 
-        }]
-    }
+        })
     
     # Note: Modern Shopify logic for resource IMAGE often allows POST with multipart.
     # We will try the standard POST flow which is safer for larger files and widely supported.
     
-    res = graphql_query(shop, access_token, staged_query, staged_vars)
+    # Only hands out new upload targets, so a replay after a 5xx is harmless
+    res = graphql_query(gql, staged_query, {"input": staged_input}, idempotent=True)
     if res["stagedUploadsCreate"]["userErrors"]:
         raise Exception(f"Staged Upload Error: {res['stagedUploadsCreate']['userErrors']}")
-        
-    target = res["stagedUploadsCreate"]["stagedTargets"][0]
+    
+    targets = res["stagedUploadsCreate"]["stagedTargets"]
+    if len(targets) != len(images):
+        raise Exception(f"Staged Upload Error: expected {len(images)} targets, got {len(targets)}")
+    return targets
+
+def put_staged_file(gql, target, img, register_file=False):
+    """
+    Upload one image to its staged target:
+    1. POST (upload bytes, multipart)
+    2. fileCreate (only if register_file)
+    Returns the staged resourceUrl, ready to be attached with attach_media.
+    """
+    filename = img["name"]
     upload_url = target["url"]
     parameters = target["parameters"]
     resource_url = target["resourceUrl"]
     
-    # 2. Upload File (Multipart POST)
-    # Prepare form data
-    form_data = {p["name"]: p["value"] for p in parameters}
+    # 1. Upload File (Multipart POST)
+    # Prepare form data; 'file' must be the last field in the form
+    fields = [(p["name"], p["value"]) for p in parameters]
     
-    # 'file' must be the last field in the form
-    with open(file_path, 'rb') as f:
-        files = {'file': (filename, f, mime_type)}
-        upload_resp = requests.post(upload_url, data=form_data, files=files, timeout=60)
-        upload_resp.raise_for_status()
+    # Stream the body from disk instead of buffering the whole image in memory.
+    # The handle is opened once and rewound for each retry.
+    f = open(img["path"], 'rb')
+    try:
+        for attempt in range(UPLOAD_MAX_ATTEMPTS):
+            f.seek(0)
+            encoder = MultipartEncoder(fields=fields + [('file', (filename, f, img["mime"]))])
+            last_attempt = attempt == UPLOAD_MAX_ATTEMPTS - 1
+            try:
+                upload_resp = gql.session.post(upload_url, data=encoder, headers={"Content-Type": encoder.content_type}, timeout=120)
+            except (requests.ConnectionError, requests.Timeout):
+                if last_attempt:
+                    raise
+                time.sleep(2 ** attempt)
+                continue
+            if upload_resp.status_code in RETRYABLE_STATUS and not last_attempt:
+                time.sleep(2 ** attempt)
+                continue
+            upload_resp.raise_for_status()
+            break
+    finally:
+        f.close()
 
-    # 3. File Create (Register the file)
-    # Important: For 'IMAGE' resource, sometimes we can go straight to productCreateMedia with resourceUrl,
-    # but strictly creating the file object first ensures it's fully registered in Shopify Files API if needed.
-    # However, productCreateMedia accepts 'originalSource'.
-    # For robustness as requested: We will try to create the media directly using the resourceUrl.
-    # If that fails historically, we'd use fileCreate. But standard "bulk" approaches usually use resourceUrl directly.
-    # The prompt requested: "some versions need fileCreate". Let's add it to be safe.
-    
-    file_create_query = """
-    mutation fileCreate($files: [FileCreateInput!]!) {
-      fileCreate(files: $files) {
-        files {
-          id
-          fileStatus
-        }
-        userErrors { field message }
-      }
-    }
-    """
-    file_create_vars = {
-        "files": [{
-            "originalSource": resource_url,
-            "filename": filename
-        }]
-    }
-    
-    fc_res = graphql_query(shop, access_token, file_create_query, file_create_vars)
-    if fc_res["fileCreate"]["userErrors"]:
-        raise Exception(f"File Create Error: {fc_res['fileCreate']['userErrors']}")
+    # 2. File Create (optional)
+    # productCreateMedia accepts the staged resourceUrl as 'originalSource' directly,
+    # so fileCreate is only needed when the image must also show up in the Files section.
+    if register_file:
+        register_staged_file(gql, resource_url, filename)
     
-    # Wait for file to be ready? usually fileCreate is async.
-    # But productCreateMedia can take the source directly too. 
-    # Actually, if we use fileCreate, we get a file ID (gid://shopify/File/...).
-    # productCreateMedia accepts `media: { originalSource: ... }`.
-    # It does NOT accept fileId directly in all versions (usually mediaContentType: IMAGE + originalSource).
-    # So using `resource_url` (the staged upload result) as `originalSource` is the standard path.
-    # The `fileCreate` might be redundant for *product media* specifically (unlike "Files" section),
-    # but let's stick to using the `resource_url` which effectively points to the uploaded content.
-    
-    final_source = resource_url
+    return resource_url
 
-    # 4. Product Create Media
+def attach_media(gql, product_id, sources):
+    """
+    Attach staged uploads to a product with a single productCreateMedia call.
+    `sources` is a list of (resource_url, filename) in the desired media order.
+    """
     media_query = """
     mutation productCreateMedia($productId: ID!, $media: [CreateMediaInput!]!) {
       productCreateMedia(productId: $productId, media: $media) {
@@ -380,17 +566,69 @@ def upload_image(shop, access_token, product_id, file_path):
     media_vars = {
         "productId": product_id,
         "media": [{
-            "originalSource": final_source,
+            "originalSource": resource_url,
             "mediaContentType": "IMAGE"
-        }]
+        } for resource_url, _ in sources]
     }
     
-    m_res = graphql_query(shop, access_token, media_query, media_vars)
+    m_res = graphql_query(gql, media_query, media_vars)
     if m_res["productCreateMedia"]["mediaUserErrors"]:
         raise Exception(f"Media Attach Error: {m_res['productCreateMedia']['mediaUserErrors']}")
 
     return True
 
+def process_product(gql, item, image_pool, register_files=False):
+    """
+    Upload all images of a matched product and return its log entry.
+    Pipeline: one stagedUploadsCreate for every image, concurrent uploads on `image_pool`,
+    then one productCreateMedia in the folder's natural sort order.
+    """
+    product = item["product"]
+    folder = item["folder"]
+    images = folder["images"]
+    
+    product_log = {
+        "title": product["title"],
+        "folder": folder["name"],
+        "results": []
+    }
+    
+    staged = []
+    errors = {}
+    try:
+        targets = stage_uploads(gql, images)
+    except Exception as e:
+        targets = []
+        for img in images:
+            errors[img["name"]] = str(e)
+    
+    futures = [image_pool.submit(put_staged_file, gql, target, img, register_files)
+               for target, img in zip(targets, images)]
+    
+    # Collect in input order so the attached media keeps the natural sort
+    for img, future in zip(images, futures):
+        filename = img["name"]
+        try:
+            staged.append((future.result(), filename))
+        except Exception as e:
+            errors[filename] = str(e)
+    
+    if staged:
+        try:
+            attach_media(gql, product["id"], staged)
+        except Exception as e:
+            for _, filename in staged:
+                errors[filename] = str(e)
+    
+    for img in images:
+        filename = img["name"]
+        if filename in errors:
+            product_log["results"].append({"file": filename, "status": "failed", "error": errors[filename]})
+        else:
+            product_log["results"].append({"file": filename, "status": "success"})
+    
+    return product_log
+
 # --- MAIN ---
 
 def main():
@@ -401,6 +639,9 @@ def main():
     parser.add_argument("--tag", required=True, help="Product Tag to search")
     parser.add_argument("--root_folder", required=True, help="Local root folder path")
     parser.add_argument("--dry_run", type=str, default="false", help="true/false")
+    parser.add_argument("--register_files", "--register-files", action="store_true", help="Also register each image in the Shopify Files API (extra fileCreate call)")
+    parser.add_argument("--workers", type=int, default=8, help="Number of products uploaded concurrently")
+    parser.add_argument("--scan_workers", type=int, default=16, help="Number of folders scanned concurrently")
     
     args = parser.parse_args()
     is_dry_run = args.dry_run.lower() == "true"
@@ -411,79 +652,117 @@ def main():
         
     # 1. Get Token
     access_token, shop_domain = get_offline_token(args.app_base_url, args.secret, args.shop)
+    gql = make_graphql_context(shop_domain, access_token)
     
-    # 2. Fetch Products
-    products = fetch_products_by_tag(shop_domain, access_token, args.tag)
-    if not products:
-        print("No products found.")
-        return
-
-    # 3. Scan Folders
-    folders = scan_folders(args.root_folder)
+    # 2. Scan Folders (first, so products can be matched while their pages are still loading)
+    folders, folders_by_token = scan_folders(args.root_folder, args.scan_workers)
     if not folders:
         print("No valid image folders found.")
         return
 
-    # 4. Match
-    matched, unmatched, collisions = match_products_to_folders(products, folders)
-    
-    # 5. Report & Stats
-    print("\n📊 MATCHING SUMMARY:")
-    print(f"   Matched: {len(matched)}")
-    print(f"   Unmatched: {len(unmatched)}")
-    print(f"   Collisions: {len(collisions)}")
-    
-    # Write JSON reports
-    with open("matched.json", "w", encoding="utf-8") as f:
-        json.dump(matched, f, indent=2, default=str)
-    with open("unmatched.json", "w", encoding="utf-8") as f:
-        json.dump(unmatched, f, indent=2)
-    with open("collisions.json", "w", encoding="utf-8") as f:
-        json.dump(collisions, f, indent=2)
-        
-    print("📝 saved matched.json, unmatched.json, collisions.json")
-    
-    if len(collisions) > 0:
-        print("⚠️  WARNING: Collisions detected. See collisions.json. These will be SKIPPED.")
-        
-    if is_dry_run:
-        print("\n🛑 Dry run complete. Exiting.")
-        return
+    # 3. Fetch & Match
+    # A background thread pages through products and matches them as they arrive;
+    # unique matches go straight onto the upload queue while later pages are fetched.
+    print("🧩 Matching products to folders...")
+    matcher = ProductMatcher(folders, folders_by_token)
+    upload_queue = queue.Queue()
+    producer_errors = []
+    
+    def produce():
+        try:
+            for product in iter_products_by_tag(gql, args.tag):
+                match = matcher.add(product)
+                if match and not is_dry_run:
+                    upload_queue.put(match)
+            for match in matcher.resolve():
+                if not is_dry_run:
+                    upload_queue.put(match)
+        except Exception as e:
+            producer_errors.append(e)
+        finally:
+            upload_queue.put(None) # Sentinel: matching is complete
+    
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
 
-    # 6. Upload
-    print("\n🚀 Starting Uploads for MATCHED items...")
-    
-    upload_log = []
+    # 4. Upload
+    if not is_dry_run:
+        print("\n🚀 Starting Uploads for MATCHED items...")
+    
+    log_lock = threading.Lock()
+    
+    def on_done(item, future):
+        try:
+            product_log = future.result()
+        except Exception as e:
+            # concurrent.futures swallows callback errors, so never let a product vanish from the log
+            product_log = {
+                "title": item["product"]["title"],
+                "folder": item["folder"]["name"],
+                "results": [{"file": img["name"], "status": "failed", "error": str(e)} for img in item["folder"]["images"]]
+            }
+        # Print a product's lines together so they don't interleave with other workers
+        with log_lock:
+            tqdm.write(f"\nProcessed: {product_log['title']} ({len(product_log['results'])} images)")
+            for r in product_log["results"]:
+                if r["status"] == "success":
+                    tqdm.write(f"   ✅ Uploaded: {r['file']}")
+                else:
+                    tqdm.write(f"   ❌ Failed: {r['file']} - {r['error']}")
+            # One NDJSON line per product, flushed so the log survives a crash mid-run
+            logf.write(_json_dumps(product_log) + b"\n")
+            logf.flush()
+            pbar.update(1)
     
-    for item in tqdm(matched, desc="Processing Products"):
-        product = item["product"]
-        folder = item["folder"]
-        images = folder["images"]
+    # Separate pools: product workers block on their image futures, so sharing one pool could deadlock.
+    # image_pool is entered first so it exits last, after every queued product has finished.
+    # Dry runs never upload, so they leave any previous upload log untouched
+    with (open("upload_log.ndjson", "wb") if not is_dry_run else contextlib.nullcontext()) as logf, \
+            tqdm(desc="Processing Products", unit="product", disable=is_dry_run) as pbar, \
+            ThreadPoolExecutor(max_workers=args.workers * 2) as image_pool, \
+            ThreadPoolExecutor(max_workers=args.workers) as ex:
+        while True:
+            item = upload_queue.get()
+            if item is None:
+                break
+            ex.submit(process_product, gql, item, image_pool, args.register_files).add_done_callback(functools.partial(on_done, item))
         
-        product_log = {
-            "title": product["title"],
-            "folder": folder["name"],
-            "results": []
-        }
+        producer.join()
+        if producer_errors:
+            raise producer_errors[0]
         
-        print(f"\nProcessing: {product['title']} ({len(images)} images)")
+        matched = matcher.matched_results
+        unmatched, collisions = matcher.classify()
+        if not matcher.product_candidates:
+            print("No products found.")
+            return
         
-        for img_path in images:
-            filename = os.path.basename(img_path)
-            try:
-                upload_image(shop_domain, access_token, product["id"], img_path)
-                print(f"   ✅ Uploaded: {filename}")
-                product_log["results"].append({"file": filename, "status": "success"})
-            except Exception as e:
-                print(f"   ❌ Failed: {filename} - {e}")
-                product_log["results"].append({"file": filename, "status": "failed", "error": str(e)})
-                
-        upload_log.append(product_log)
+        # 5. Report & Stats
+        print("\n📊 MATCHING SUMMARY:")
+        print(f"   Matched: {len(matched)}")
+        print(f"   Unmatched: {len(unmatched)}")
+        print(f"   Collisions: {len(collisions)}")
         
-    # Save Upload Log
-    with open("upload_log.json", "w", encoding="utf-8") as f:
-        json.dump(upload_log, f, indent=2)
-    
+        # Write JSON reports
+        with open("matched.json", "wb") as f:
+            f.write(_json_dumps(matched, indent=True, default=str))
+        with open("unmatched.json", "wb") as f:
+            f.write(_json_dumps(unmatched, indent=True))
+        with open("collisions.json", "wb") as f:
+            f.write(_json_dumps(collisions, indent=True))
+            
+        print("📝 saved matched.json, unmatched.json, collisions.json")
+        
+        if len(collisions) > 0:
+            print("⚠️  WARNING: Collisions detected. See collisions.json. These will be SKIPPED.")
+            
+        if is_dry_run:
+            print("\n🛑 Dry run complete. Exiting.")
+            return
+        
+        # Leaving the block waits for the remaining uploads
+        
+    print("📝 saved upload_log.ndjson")
     print("\n✅ Bulk Upload Process Completed!")
 
 if __name__ == "__main__":
@@ -0,0 +1,168 @@
+import json
+import sys
+
+import pytest
+
+import bulk_upload_images as bulk
+
+UPLOAD_URL = "https://uploads.example.com/staged"
+
+
+class FakeResponse:
+    def __init__(self, body, status_code=200):
+        self.status_code = status_code
+        self.content = json.dumps(body).encode("utf-8")
+        self.text = self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(f"HTTP {self.status_code}")
+
+
+class FakeShopifySession:
+    """Stands in for requests.Session: token endpoint, Admin GraphQL and the staged upload target."""
+
+    def __init__(self, products, page_size=25):
+        self.products = products
+        self.page_size = page_size
+
+    def get(self, url, headers=None, params=None, timeout=None):
+        return FakeResponse({"accessToken": "tok", "shop": "test-shop.myshopify.com"})
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        if url == UPLOAD_URL:
+            data.read() # Drain the multipart stream like a real upload would
+            return FakeResponse({}, status_code=201)
+
+        payload = json.loads(data)
+        query, variables = payload["query"], payload["variables"]
+        if "getProducts" in query:
+            start = int(variables["cursor"] or 0)
+            end = start + self.page_size
+            return FakeResponse({"data": {"products": {
+                "edges": [{"node": p} for p in self.products[start:end]],
+                "pageInfo": {"hasNextPage": end < len(self.products), "endCursor": str(end)}
+            }}})
+        if "stagedUploadsCreate" in query:
+            return FakeResponse({"data": {"stagedUploadsCreate": {
+                "stagedTargets": [{
+                    "url": UPLOAD_URL,
+                    "resourceUrl": f"https://cdn.example.com/{i['filename']}",
+                    "parameters": [{"name": "key", "value": i["filename"]}]
+                } for i in variables["input"]],
+                "userErrors": []
+            }}})
+        if "productCreateMedia" in query:
+            return FakeResponse({"data": {"productCreateMedia": {"media": [], "mediaUserErrors": []}}})
+        raise AssertionError(f"Unexpected GraphQL query: {query}")
+
+
+def make_catalog(root, count, images_per_folder=2):
+    products = []
+    for n in range(count):
+        title = f"Product {n} Perde"
+        products.append({"id": f"gid://shopify/Product/{n}", "title": title, "handle": f"product-{n}"})
+        sub = root / title / "Etulle Shopify"
+        sub.mkdir(parents=True)
+        for i in range(1, images_per_folder + 1):
+            (sub / f"img_{i}.jpg").write_bytes(b"\xff\xd8" + bytes(i))
+    return products
+
+
+def run_main(monkeypatch, tmp_path, products, *extra_args):
+    root = tmp_path / "images"
+    root.mkdir(exist_ok=True)
+    out = tmp_path / "out"
+    out.mkdir()
+    monkeypatch.chdir(out)
+    monkeypatch.setattr(sys, "argv", [
+        "bulk_upload_images.py",
+        "--app_base_url", "https://app.example.com",
+        "--secret", "s",
+        "--tag", "t",
+        "--root_folder", str(root),
+        *extra_args
+    ])
+    bulk.main()
+    return [json.loads(line) for line in (out / "upload_log.ndjson").read_text(encoding="utf-8").splitlines()]
+
+
+def test_main_logs_every_matched_product(monkeypatch, tmp_path):
+    root = tmp_path / "images"
+    root.mkdir()
+    products = make_catalog(root, 60)
+    monkeypatch.setattr(bulk, "SESSION", FakeShopifySession(products))
+
+    log = run_main(monkeypatch, tmp_path, products, "--workers", "4")
+
+    assert sorted(entry["title"] for entry in log) == sorted(p["title"] for p in products)
+    for entry in log:
+        assert [r["file"] for r in entry["results"]] == ["img_1.jpg", "img_2.jpg"]
+        assert all(r["status"] == "success" for r in entry["results"])
+
+
+def test_main_logs_product_whose_worker_raised(monkeypatch, tmp_path):
+    root = tmp_path / "images"
+    root.mkdir()
+    products = make_catalog(root, 3)
+    monkeypatch.setattr(bulk, "SESSION", FakeShopifySession(products))
+
+    def broken_process_product(gql, item, image_pool, register_files=False):
+        raise RuntimeError("worker crashed")
+    monkeypatch.setattr(bulk, "process_product", broken_process_product)
+
+    log = run_main(monkeypatch, tmp_path, products)
+
+    assert sorted(entry["title"] for entry in log) == sorted(p["title"] for p in products)
+    for entry in log:
+        assert entry["results"] == [
+            {"file": name, "status": "failed", "error": "worker crashed"} for name in ("img_1.jpg", "img_2.jpg")
+        ]
+
+
+class ScriptedSession:
+    """Returns the given responses in order and counts the requests made."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+def test_graphql_query_does_not_replay_mutations_on_5xx(monkeypatch):
+    monkeypatch.setattr(bulk.time, "sleep", lambda seconds: None)
+    session = ScriptedSession(FakeResponse({}, status_code=502), FakeResponse({"data": {}}))
+    gql = bulk.GraphQLContext(url="https://shop/graphql.json", headers={}, session=session)
+
+    with pytest.raises(Exception, match="502"):
+        bulk.graphql_query(gql, "mutation productCreateMedia { x }")
+    assert session.calls == 1
+
+
+def test_graphql_query_retries_idempotent_5xx_and_throttling(monkeypatch):
+    monkeypatch.setattr(bulk.time, "sleep", lambda seconds: None)
+    throttled = {"errors": [{"message": "Throttled", "extensions": {"code": "THROTTLED"}}]}
+    session = ScriptedSession(
+        FakeResponse({}, status_code=503),
+        FakeResponse(throttled),
+        FakeResponse({"data": {"ok": True}})
+    )
+    gql = bulk.GraphQLContext(url="https://shop/graphql.json", headers={}, session=session)
+
+    assert bulk.graphql_query(gql, "query q { x }", idempotent=True) == {"ok": True}
+    assert session.calls == 3
+
+
+def test_graphql_query_retries_429_for_mutations(monkeypatch):
+    monkeypatch.setattr(bulk.time, "sleep", lambda seconds: None)
+    session = ScriptedSession(FakeResponse({}, status_code=429), FakeResponse({"data": {"ok": True}}))
+    gql = bulk.GraphQLContext(url="https://shop/graphql.json", headers={}, session=session)
+
+    assert bulk.graphql_query(gql, "mutation m { x }") == {"ok": True}
+    assert session.calls == 2